@@ -0,0 +1,275 @@
+"""Análise de queries SQL com o Gemini: prompt, cache das respostas e tarefa da fila.
+
+Este módulo não acessa banco nem rede ao ser importado, para que o worker do RQ
+(worker.py) possa carregá-lo sem os efeitos colaterais do api.py.
+"""
+import os
+import re
+import json
+import math
+import time
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+import redis
+import google.generativeai as genai
+from dotenv import load_dotenv
+
+dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+load_dotenv(dotenv_path=dotenv_path)
+
+
+#  CONFIGURAÇÃO DA API GEMINI
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+if not GEMINI_API_KEY:
+    print("AVISO: A variável de ambiente GEMINI_API_KEY não foi definida.")
+else:
+    # Transporte REST (requests/urllib3) em vez de gRPC: o gevent consegue
+    # tornar essas chamadas cooperativas nos workers do gunicorn.
+    genai.configure(api_key=GEMINI_API_KEY, transport='rest')
+    print("SUCESSO: A API do Gemini foi configurada.")
+
+GEMINI_MODEL_NAME = 'gemini-2.5-pro'
+GEMINI_EMBED_MODEL = 'models/text-embedding-004'
+
+# Parte fixa do prompt: vai como instrução de sistema, sempre idêntica, para
+# aproveitar o cache implícito de prefixo do Gemini. (É pequena demais para o
+# cache explícito, CachedContent, que exige um mínimo de tokens.)
+# Conteúdo variável (a query) fica sempre no final, na mensagem do usuário.
+PROMPT_SISTEMA = (
+    "Você é um especialista em SQL. Analise a query enviada e explique o que ela faz "
+    "em um parágrafo claro e conciso, e depois liste o que cada função principal faz."
+)
+PROMPT_QUERY_TMPL = "Query SQL:\n```sql\n%s\n```\n"
+
+# Instância única do modelo, compartilhada por todas as requisições (o cliente
+# do SDK pode ser usado por várias threads/greenlets ao mesmo tempo). Assim as
+# conexões HTTPS com a API do Gemini são reaproveitadas entre chamadas.
+gemini_model = (
+    genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=PROMPT_SISTEMA)
+    if GEMINI_API_KEY else None
+)
+
+
+#  CACHE DAS RESPOSTAS DA IA
+_SQL_KEYWORDS = {
+    'select', 'from', 'where', 'and', 'or', 'not', 'in', 'is', 'null', 'as',
+    'join', 'inner', 'left', 'right', 'full', 'outer', 'cross', 'on', 'using',
+    'group', 'by', 'order', 'having', 'limit', 'offset', 'distinct', 'union',
+    'all', 'insert', 'into', 'values', 'update', 'set', 'delete', 'with',
+    'case', 'when', 'then', 'else', 'end', 'between', 'like', 'exists', 'asc',
+    'desc', 'count', 'sum', 'avg', 'min', 'max', 'over', 'partition',
+}
+
+
+# Queries maiores que isso são recusadas antes de chegar ao Gemini (cobrança por token).
+MAX_QUERY_CHARS = 8192
+
+
+# Tokens de SQL relevantes para limpeza/normalização. Strings entre aspas vêm
+# primeiro para que '--', '/*' ou palavras-chave dentro delas não sejam alterados.
+_SQL_TOKENS = re.compile(
+    r"""(?P<literal>'(?:[^']|'')*'?|"(?:[^"]|"")*"?)"""
+    r"|(?P<comentario>--[^\n]*|/\*.*?(?:\*/|$))"
+    r"|(?P<espaco>\s+)"
+    r"|(?P<palavra>\b[A-Za-z_]+\b)",
+    re.S,
+)
+
+
+def _colapsar_espacos(query):
+    return _SQL_TOKENS.sub(lambda m: ' ' if m.lastgroup == 'espaco' else m.group(0), query).strip()
+
+
+def limpar_sql(query):
+    """Remove comentários e espaços extras da query, reduzindo os tokens enviados à IA."""
+    sem_comentarios = _SQL_TOKENS.sub(lambda m: ' ' if m.lastgroup == 'comentario' else m.group(0), query)
+    return _colapsar_espacos(sem_comentarios)
+
+
+def normalizar_sql(query):
+    """Deixa as palavras-chave em minúsculas e colapsa os espaços em branco (fora das strings)."""
+    def minusculas(m):
+        if m.lastgroup == 'palavra' and m.group(0).lower() in _SQL_KEYWORDS:
+            return m.group(0).lower()
+        return m.group(0)
+    return _SQL_TOKENS.sub(minusculas, _colapsar_espacos(query))
+
+
+def _similaridade_cosseno(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norma = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norma if norma else 0.0
+
+
+class LLMCache:
+    """Cache em duas camadas para as explicações do Gemini.
+
+    A primeira camada usa a chave exata (SHA-256 do modelo + SQL normalizado).
+    A segunda compara o embedding da query com as entradas recentes e reaproveita
+    a resposta quando a similaridade passa do limiar. Usa o Redis quando REDIS_URL
+    está definida; caso contrário, guarda tudo em memória no próprio processo
+    (LRU limitado a max_entradas). Falhas do Redis contam como cache miss.
+    """
+
+    PREFIXO = 'llmcache:'
+
+    def __init__(self, model_name, redis_url=None, ttl=3600, limiar=0.92, max_semanticos=200, max_entradas=1000):
+        self.model_name = model_name
+        self.ttl = ttl
+        self.limiar = limiar
+        self.max_semanticos = max_semanticos
+        self.max_entradas = max_entradas
+        self._redis = None
+        self._local = OrderedDict()
+        self._semanticos = deque(maxlen=max_semanticos)
+        self._lock = threading.Lock()
+        if redis_url:
+            # A conexão só é aberta no primeiro uso.
+            self._redis = redis.Redis.from_url(redis_url)
+
+    def key(self, query):
+        base = self.model_name + normalizar_sql(query)
+        return hashlib.sha256(base.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if self._redis is not None:
+            try:
+                valor = self._redis.get(self.PREFIXO + key)
+            except redis.RedisError as e:
+                print(f"AVISO: Falha ao ler o cache no Redis: {e}")
+                return None
+            return valor.decode('utf-8') if valor is not None else None
+        with self._lock:
+            item = self._local.get(key)
+            if item is None:
+                return None
+            expira_em, valor = item
+            if expira_em < time.monotonic():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+            return valor
+
+    def set(self, key, valor, embedding=None):
+        if self._redis is not None:
+            pipe = self._redis.pipeline()
+            pipe.set(self.PREFIXO + key, valor, ex=self.ttl)
+            if embedding is not None:
+                chave_sem = self.PREFIXO + 'semanticos'
+                pipe.lpush(chave_sem, json.dumps({'e': embedding, 'v': valor}))
+                pipe.ltrim(chave_sem, 0, self.max_semanticos - 1)
+                pipe.expire(chave_sem, self.ttl)
+            try:
+                pipe.execute()
+            except redis.RedisError as e:
+                print(f"AVISO: Falha ao gravar o cache no Redis: {e}")
+            return
+        expira_em = time.monotonic() + self.ttl
+        with self._lock:
+            self._local[key] = (expira_em, valor)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_entradas:
+                self._local.popitem(last=False)
+            if embedding is not None:
+                self._semanticos.appendleft((expira_em, embedding, valor))
+
+    def embed(self, query):
+        """Calcula o embedding da query. Retorna None se a API falhar."""
+        try:
+            resultado = genai.embed_content(model=GEMINI_EMBED_MODEL, content=normalizar_sql(query))
+            return resultado['embedding']
+        except Exception as e:
+            print(f"AVISO: Não foi possível calcular o embedding da query: {e}")
+            return None
+
+    def buscar_semelhante(self, embedding):
+        """Retorna a explicação mais parecida acima do limiar, se houver."""
+        if embedding is None:
+            return None
+        if self._redis is not None:
+            try:
+                brutos = self._redis.lrange(self.PREFIXO + 'semanticos', 0, -1)
+            except redis.RedisError as e:
+                print(f"AVISO: Falha ao ler o cache semântico no Redis: {e}")
+                return None
+            candidatos = [(item['e'], item['v']) for item in map(json.loads, brutos)]
+        else:
+            agora = time.monotonic()
+            with self._lock:
+                candidatos = [(e, v) for expira_em, e, v in self._semanticos if expira_em >= agora]
+
+        melhor, melhor_sim = None, self.limiar
+        for candidato, valor in candidatos:
+            sim = _similaridade_cosseno(embedding, candidato)
+            if sim > melhor_sim:
+                melhor, melhor_sim = valor, sim
+        return melhor
+
+
+llm_cache = LLMCache(GEMINI_MODEL_NAME, redis_url=os.getenv('REDIS_URL'))
+
+
+def buscar_semelhante(query_para_analisar, chave):
+    """Busca no cache semântico. Retorna (embedding, explicação ou None)."""
+    embedding = llm_cache.embed(query_para_analisar)
+    hit = llm_cache.buscar_semelhante(embedding)
+    if hit is not None:
+        llm_cache.set(chave, hit)
+    return embedding, hit
+
+
+def gerar_explicacao(query_para_analisar, chave, embedding):
+    """Chama o Gemini e grava a explicação no cache."""
+    response = gemini_model.generate_content(PROMPT_QUERY_TMPL % query_para_analisar)
+    explicacao = response.text.strip()
+    llm_cache.set(chave, explicacao, embedding)
+    return explicacao
+
+
+# Chamadas ao Gemini em andamento, por chave do cache. Requisições simultâneas
+# para a mesma query esperam a primeira em vez de chamar a API de novo.
+# (Com os workers gevent, o threading é substituído por primitivas cooperativas.)
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def singleflight(chave, funcao, *args):
+    """Executa funcao(*args) uma única vez por chave entre chamadas concorrentes."""
+    with _inflight_lock:
+        futuro = _inflight.get(chave)
+        dono = futuro is None
+        if dono:
+            futuro = Future()
+            _inflight[chave] = futuro
+    if not dono:
+        return futuro.result()
+
+    try:
+        resultado = funcao(*args)
+    except Exception as e:
+        futuro.set_exception(e)
+        raise
+    else:
+        futuro.set_result(resultado)
+        return resultado
+    finally:
+        with _inflight_lock:
+            del _inflight[chave]
+
+
+def call_gemini(query_para_analisar):
+    """Tarefa executada pelos workers do RQ: gera a explicação (ou usa o cache).
+
+    Cada job roda em um processo próprio do worker, então o singleflight não se
+    aplica aqui; jobs repetidos são resolvidos pelo cache no Redis, compartilhado
+    com a API.
+    """
+    chave = llm_cache.key(query_para_analisar)
+    if (hit := llm_cache.get(chave)) is not None:
+        return hit
+    embedding, hit = buscar_semelhante(query_para_analisar, chave)
+    if hit is not None:
+        return hit
+    return gerar_explicacao(query_para_analisar, chave, embedding)
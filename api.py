@@ -1,19 +1,60 @@
 import os
-from flask import Flask, request, jsonify, abort
+import json
+import decimal
+import hashlib
+import orjson
+import msgspec
+from typing import Annotated, Optional
+import redis
+from rq import Queue
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
+from flask import Flask, Response, request, jsonify, abort, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
-import google.generativeai as genai
+from sqlalchemy import event, select, text
+from sqlalchemy.schema import CreateIndex
 from dotenv import load_dotenv
+from flask.json.provider import JSONProvider
 from flask_cors import CORS 
+from flask_caching import Cache
+from analise import (
+    GEMINI_API_KEY, MAX_QUERY_CHARS, PROMPT_QUERY_TMPL, buscar_semelhante, gemini_model,
+    gerar_explicacao, limpar_sql, llm_cache, singleflight,
+)
 
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 load_dotenv(dotenv_path=dotenv_path)
 
 
+def _orjson_default(obj):
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    raise TypeError(f"Objeto do tipo {type(obj).__name__} não é serializável em JSON")
+
+
+class OrjsonProvider(JSONProvider):
+    """Provider JSON do Flask usando orjson (extensão em C) em todas as respostas jsonify."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=_orjson_default, option=orjson.OPT_NAIVE_UTC).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Pega a URL exata do seu site na Vercel
 vercel_url = "https://organizador-select-com-ia.vercel.app"
-CORS(app, resources={r"/api/*": {"origins": vercel_url}})
+# max_age deixa o navegador reaproveitar o preflight (OPTIONS) por 24h.
+CORS(app, resources={r"/api/*": {
+    "origins": vercel_url,
+    "methods": ["GET", "POST", "DELETE"],
+    "allow_headers": ["Content-Type", "Prefer"],
+    "expose_headers": ["X-Next-Cursor"],
+    "max_age": 86400,
+}})
 
 db_uri = os.getenv('DATABASE_URL')
 
@@ -23,19 +64,40 @@ if not db_uri:
 
 app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# O pool é por processo: divide o orçamento total de conexões do banco
+# (DB_MAX_CONNECTIONS, padrão 90, abaixo do limite do Postgres no Render)
+# entre os workers do gunicorn (WEB_CONCURRENCY, definido em gunicorn.conf.py).
+# pool_recycle abaixo do tempo limite de conexões ociosas do Postgres no Render.
+_conexoes_por_worker = max(2, int(os.getenv('DB_MAX_CONNECTIONS', 90)) // int(os.getenv('WEB_CONCURRENCY', 1)))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': _conexoes_por_worker // 2,
+    'max_overflow': _conexoes_por_worker - _conexoes_por_worker // 2,
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+}
 db = SQLAlchemy(app)
 
-#  CONFIGURAÇÃO DA API GEMINI
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    print("AVISO: A variável de ambiente GEMINI_API_KEY não foi definida.")
+# Cache das listagens de cards só com Redis, compartilhado entre os workers.
+# Um cache em memória por processo não seria invalidado pelos outros workers,
+# então sem Redis o cache fica desligado (NullCache).
+redis_url = os.getenv('REDIS_URL')
+if redis_url:
+    cache = Cache(app, config={'CACHE_TYPE': 'RedisCache', 'CACHE_REDIS_URL': redis_url})
 else:
-    genai.configure(api_key=GEMINI_API_KEY)
-    print("SUCESSO: A API do Gemini foi configurada.")
+    cache = Cache(app, config={'CACHE_TYPE': 'NullCache'})
+
 
+# Fila para rodar as análises fora da requisição (worker: python worker.py).
+# Só existe quando há Redis; sem ele, as análises são sempre síncronas.
+fila_llm = Queue('llm', connection=redis.Redis.from_url(redis_url)) if redis_url else None
 
 
 class QueryCard(db.Model):
+    __table_args__ = (
+        db.Index('ix_querycard_cliente', 'cliente'),
+        db.Index('ix_querycard_id_desc', text('id DESC')),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     cliente = db.Column(db.String(120), nullable=False)
     observacao = db.Column(db.Text, nullable=True)
@@ -50,79 +112,293 @@ class QueryCard(db.Model):
         }
 
 
+class CardIn(msgspec.Struct):
+    """Payload de criação de card; validado e decodificado em uma única passada pelo msgspec."""
+    cliente: Annotated[str, msgspec.Meta(min_length=1)]
+    query: Annotated[str, msgspec.Meta(min_length=1)]
+    obs: Optional[str] = ''
+
+    def to_model(self):
+        return QueryCard(cliente=self.cliente, observacao=self.obs, query_sql=self.query)
+
+
+CARD_DECODER = msgspec.json.Decoder(CardIn)
+CARDS_DECODER = msgspec.json.Decoder(list[CardIn])
+
+
 # Cria as tabelas no banco de dados, se não existirem
 with app.app_context():
+    # No SQLite local: WAL para que leituras não fiquem bloqueadas durante escritas.
+    if db_uri.startswith('sqlite'):
+        @event.listens_for(db.engine, 'connect')
+        def _sqlite_pragmas(dbapi_conn, connection_record):
+            cur = dbapi_conn.cursor()
+            cur.execute('PRAGMA journal_mode=WAL')
+            cur.execute('PRAGMA synchronous=NORMAL')
+            cur.execute('PRAGMA temp_store=MEMORY')
+            cur.execute('PRAGMA mmap_size=268435456')
+            cur.close()
+
     db.create_all()
+    # create_all não adiciona índices novos em tabelas que já existem. Como todos
+    # os workers do gunicorn passam por aqui ao mesmo tempo, usa IF NOT EXISTS e
+    # trata a corrida: se outro worker criou o índice primeiro, só segue em frente.
+    for index in QueryCard.__table__.indexes:
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+        except Exception as e:
+            print(f"AVISO: Não foi possível criar o índice {index.name}: {e}")
+    # No Postgres, índice trigram para buscas com LIKE '%...%' por cliente.
+    if db.engine.dialect.name == 'postgresql':
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+                conn.execute(text(
+                    "CREATE INDEX IF NOT EXISTS ix_querycard_cliente_trgm "
+                    "ON query_card USING gin (cliente gin_trgm_ops)"
+                ))
+        except Exception as e:
+            print(f"AVISO: Não foi possível criar o índice trigram em cliente: {e}")
     print("Banco de dados e tabelas criados/verificados com sucesso.")
 
 
+# Corpo fixo da rota principal, serializado uma única vez (é usada como healthcheck).
+_INDEX_BODY = orjson.dumps({"status": "online", "message": "API do Gerenciador de Queries está no ar!"})
+
+
 @app.route('/')
 def index():
     """Rota principal para verificar se a API está online."""
-    return {"status": "online", "message": "API do Gerenciador de Queries está no ar!"}
+    return Response(_INDEX_BODY, mimetype='application/json')
 
 
 @app.route('/api/cards', methods=['GET', 'POST'])
 def handle_cards():
     """Rota para buscar todos os cards ou criar um novo."""
     if request.method == 'POST':
-        data = request.json
-        if not data or not data.get('cliente') or not data.get('query'):
-            abort(400, description="Cliente e Query são campos obrigatórios.")
-        
-        new_card = QueryCard(
-            cliente=data['cliente'], 
-            observacao=data.get('obs', ''), 
-            query_sql=data['query']
-        )
+        try:
+            card_in = CARD_DECODER.decode(request.get_data())
+        except msgspec.DecodeError as e:
+            abort(400, description=f"Cliente e Query são campos obrigatórios. ({e})")
+
+        new_card = card_in.to_model()
         db.session.add(new_card)
         db.session.commit()
+        _invalidar_cards()
         return jsonify(new_card.to_dict()), 201
     else:  # GET
-        cards = QueryCard.query.order_by(QueryCard.id.desc()).all()
-        return jsonify([card.to_dict() for card in cards])
+        # Paginação opcional por cursor: ?limit=N&cursor=<id do último card recebido>.
+        # O próximo cursor vai no cabeçalho X-Next-Cursor. Sem esses parâmetros,
+        # retorna todos os cards, como o frontend atual espera.
+        limit = request.args.get('limit', type=int)
+        cursor = request.args.get('cursor', type=int)
+        if limit is not None or cursor is not None:
+            limit = max(1, min(limit or 50, 200))
+        # ?summary=1 traz só id e cliente, sem carregar o texto da query.
+        summary = request.args.get('summary') == '1'
+
+        # O ETag vem junto com o corpo (hash do próprio JSON), então um 304 só
+        # acontece quando o cliente já tem exatamente esse conteúdo.
+        body, next_cursor, etag = _get_cards_cached(limit, cursor, summary)
+        if request.if_none_match.contains_weak(etag):
+            resp = app.response_class(status=304)
+            resp.set_etag(etag, weak=True)
+            return resp
+
+        resp = app.response_class(body, mimetype='application/json')
+        resp.set_etag(etag, weak=True)
+        if next_cursor is not None:
+            resp.headers['X-Next-Cursor'] = str(next_cursor)
+        return resp
+
+
+# TTL curto: se alguma invalidação se perder, o cache se corrige sozinho.
+@cache.memoize(timeout=30)
+def _get_cards_cached(limit, cursor, summary):
+    """Busca uma página de cards e retorna (JSON já serializado, próximo cursor, ETag)."""
+    # Seleciona só as colunas (tuplas), sem montar objetos do ORM para cada linha.
+    if summary:
+        stmt = select(QueryCard.id, QueryCard.cliente)
+    else:
+        stmt = select(QueryCard.id, QueryCard.cliente, QueryCard.observacao, QueryCard.query_sql)
+    stmt = stmt.order_by(QueryCard.id.desc())
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    if cursor:
+        stmt = stmt.where(QueryCard.id < cursor)
+    cards = db.session.execute(stmt).all()
+
+    if summary:
+        body = orjson.dumps([{'id': r[0], 'cliente': r[1]} for r in cards])
+    else:
+        body = orjson.dumps([{'id': r[0], 'cliente': r[1], 'obs': r[2], 'query': r[3]} for r in cards])
+    next_cursor = cards[-1].id if limit is not None and len(cards) == limit else None
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    return body, next_cursor, etag
+
+
+def _invalidar_cards():
+    """Limpa o cache das listagens após uma escrita.
+
+    Roda depois do commit, então uma falha do Redis não pode virar erro na
+    resposta: só registra o aviso e deixa o TTL de 30s corrigir o cache.
+    """
+    try:
+        cache.delete_memoized(_get_cards_cached)
+    except redis.RedisError as e:
+        print(f"AVISO: Falha ao invalidar o cache de cards no Redis: {e}")
+
+
+# Limite de cards por lote, para manter a transação curta.
+MAX_CARDS_POR_LOTE = 500
+
+
+@app.route('/api/cards/batch', methods=['POST'])
+def batch_cards():
+    """Cria vários cards de uma vez, em uma única transação.
+
+    Recebe uma lista com os mesmos campos do POST /api/cards (máximo de
+    MAX_CARDS_POR_LOTE itens). Se algum item for inválido, nada é gravado e o
+    erro indica a posição do item.
+    """
+    try:
+        items = CARDS_DECODER.decode(request.get_data())
+    except msgspec.DecodeError as e:
+        # A mensagem do msgspec indica a posição do item inválido, ex.: `$[3]`.
+        abort(400, description=f"Envie uma lista de cards com Cliente e Query. ({e})")
+    if not items:
+        abort(400, description="Envie uma lista de cards.")
+    if len(items) > MAX_CARDS_POR_LOTE:
+        abort(400, description=f"O lote pode ter no máximo {MAX_CARDS_POR_LOTE} cards.")
+
+    new_cards = [item.to_model() for item in items]
+    db.session.bulk_save_objects(new_cards, return_defaults=True)
+    db.session.commit()
+    _invalidar_cards()
+    return jsonify([card.to_dict() for card in new_cards]), 201
+
+
+def _evento_sse(dados, evento=None):
+    """Formata uma mensagem no padrão Server-Sent Events."""
+    prefixo = f"event: {evento}\n" if evento else ""
+    return f"{prefixo}data: {json.dumps(dados)}\n\n"
+
+
+def _resposta_sse(gerador):
+    return Response(stream_with_context(gerador), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def _stream_cache(explicacao):
+    yield _evento_sse({'token': explicacao, 'cached': True})
+    yield _evento_sse({}, evento='fim')
+
+
+def _stream_gemini(prompt, chave, embedding):
+    """Repassa os tokens do Gemini conforme chegam e guarda o texto completo no cache ao final."""
+    buffer = []
+    try:
+        for chunk in gemini_model.generate_content(prompt, stream=True):
+            buffer.append(chunk.text)
+            yield _evento_sse({'token': chunk.text})
+    except Exception as e:
+        print(f"Um erro inesperado ocorreu na análise da IA: {e}")
+        yield _evento_sse({'erro': f'Ocorreu um erro ao contatar a API de IA: {str(e)}'}, evento='erro')
+        return
+    llm_cache.set(chave, ''.join(buffer).strip(), embedding)
+    yield _evento_sse({}, evento='fim')
 
 
 @app.route('/api/analisar-query', methods=['POST'])
 def analisar_query():
-    """Recebe uma query e a envia para a API do Gemini para análise."""
+    """Recebe uma query e a envia para a API do Gemini para análise.
+
+    Se o cliente enviar 'Accept: text/event-stream', a explicação é transmitida
+    token a token via Server-Sent Events. Com 'Prefer: respond-async' (e Redis
+    configurado), a análise vai para a fila e a resposta é 202 com o job_id, a ser
+    consultado em GET /api/analisar-query/<job_id>. Caso contrário, retorna o JSON completo.
+    """
     if not GEMINI_API_KEY:
         return jsonify({'erro': 'A chave da API Gemini não foi configurada no servidor.'}), 500
+
+    data = request.json
+    query_para_analisar = data.get('query') if isinstance(data, dict) else None
+    if not query_para_analisar or not isinstance(query_para_analisar, str):
+        abort(400, description="Nenhuma query foi fornecida para análise.")
+    if len(query_para_analisar) > MAX_QUERY_CHARS:
+        abort(413, description=f"Query excede {MAX_QUERY_CHARS} caracteres.")
+    query_para_analisar = limpar_sql(query_para_analisar)
+    if not query_para_analisar:
+        abort(400, description="Nenhuma query foi fornecida para análise.")
+
     try:
-        data = request.json
-        query_para_analisar = data.get('query')
-        if not query_para_analisar:
-            abort(400, description="Nenhuma query foi fornecida para análise.")
-
-        model = genai.GenerativeModel('gemini-2.5-pro')
-        
-        prompt = f"""
-        Você é um especialista em SQL. Analise a query abaixo e explique o que ela faz em um parágrafo claro e conciso, e depois liste o que cada função principal faz.
-
-        Query SQL:
-        ```sql
-        {query_para_analisar}
-        ```
-        """
-        response = model.generate_content(prompt)
-        explicacao = response.text
-        return jsonify({'explicacao': explicacao.strip()})
+        streaming = 'text/event-stream' in request.headers.get('Accept', '')
+        assincrono = fila_llm is not None and 'respond-async' in request.headers.get('Prefer', '')
+
+        chave = llm_cache.key(query_para_analisar)
+        hit = llm_cache.get(chave)
+        if hit is None and assincrono:
+            try:
+                job = fila_llm.enqueue('analise.call_gemini', query_para_analisar, job_timeout=120, result_ttl=3600)
+                return jsonify({'job_id': job.id}), 202
+            except redis.RedisError as e:
+                # Sem a fila, a análise segue pelo caminho síncrono.
+                print(f"AVISO: Fila de análises indisponível, respondendo de forma síncrona: {e}")
+
+        embedding = None
+        if hit is None:
+            embedding, hit = buscar_semelhante(query_para_analisar, chave)
+        if hit is not None:
+            if streaming:
+                return _resposta_sse(_stream_cache(hit))
+            return jsonify({'explicacao': hit, 'cached': True})
+
+        if streaming:
+            prompt = PROMPT_QUERY_TMPL % query_para_analisar
+            return _resposta_sse(_stream_gemini(prompt, chave, embedding))
+
+        explicacao = singleflight(chave, gerar_explicacao, query_para_analisar, chave, embedding)
+        return jsonify({'explicacao': explicacao})
 
     except Exception as e:
         print(f"Um erro inesperado ocorreu na análise da IA: {e}")
         return jsonify({'erro': f'Ocorreu um erro ao contatar a API de IA: {str(e)}'}), 500
 
 
+@app.route('/api/analisar-query/<job_id>', methods=['GET'])
+def status_analise(job_id):
+    """Consulta o andamento de uma análise enviada para a fila."""
+    if fila_llm is None:
+        abort(404, description="Análises em segundo plano não estão habilitadas.")
+    try:
+        job = Job.fetch(job_id, connection=fila_llm.connection)
+        status = job.get_status()
+        resultado = job.return_value()
+    except NoSuchJobError:
+        abort(404, description="Análise não encontrada.")
+    except redis.RedisError as e:
+        print(f"AVISO: Fila de análises indisponível: {e}")
+        return jsonify({'erro': 'A fila de análises está indisponível no momento.'}), 503
+
+    resposta = {'status': status, 'result': resultado}
+    if status == 'failed':
+        resposta['erro'] = 'Ocorreu um erro ao contatar a API de IA.'
+    return jsonify(resposta)
+
+
 @app.route('/api/cards/<int:card_id>', methods=['DELETE'])
 def delete_card(card_id):
     """Rota para deletar um card específico."""
-    card = QueryCard.query.get(card_id)
+    card = db.session.get(QueryCard, card_id)
     if card is None:
         abort(404, description="Card não encontrado.")
     db.session.delete(card)
     db.session.commit()
+    _invalidar_cards()
     return jsonify({'message': 'Card excluído com sucesso!'})
 
+# Em produção use o gunicorn (veja wsgi.py e gunicorn.conf.py).
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5001)
 
@@ -0,0 +1,50 @@
+import os
+import multiprocessing
+
+# Configuração do gunicorn, carregada automaticamente ao rodar: gunicorn wsgi:app
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+
+# Workers gevent: enquanto uma chamada ao Gemini ou ao banco espera I/O,
+# o mesmo worker continua atendendo as outras requisições.
+# Sem gevent, use GUNICORN_WORKER_CLASS=gthread (8 threads por worker).
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+if worker_class == 'gthread':
+    threads = int(os.getenv('GUNICORN_THREADS', 8))
+else:
+    worker_connections = 1000
+
+
+def post_fork(server, worker):
+    """Repassa ao worker o número real de workers (inclui -w na linha de comando).
+
+    O api.py divide o pool de conexões do banco por WEB_CONCURRENCY. Isso roda
+    no processo do worker antes de o app ser importado (não usamos preload_app).
+    """
+    os.environ['WEB_CONCURRENCY'] = str(server.num_workers)
+
+
+def post_worker_init(worker):
+    """Aquece as conexões com o Gemini e com o banco antes do worker receber tráfego.
+
+    Roda depois do monkey patch do gevent e do carregamento do app (o post_fork
+    seria cedo demais para isso). count_tokens usa o mesmo serviço do
+    generate_content, mas não gera texto nem é cobrado.
+    """
+    import api
+    import analise
+
+    if analise.gemini_model is not None:
+        try:
+            # Limitado a 5s e sem retry: o worker ainda não manda heartbeat aqui,
+            # e o arbiter o mataria após o timeout (30s) se o Gemini travar.
+            analise.gemini_model.count_tokens('warmup', request_options={'timeout': 5, 'retry': None})
+        except Exception as e:
+            worker.log.warning("Falha ao aquecer a conexão com o Gemini: %s", e)
+
+    try:
+        with api.app.app_context():
+            api.db.session.execute(api.text('SELECT 1'))
+            api.db.session.remove()
+    except Exception as e:
+        worker.log.warning("Falha ao aquecer o pool do banco: %s", e)
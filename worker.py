@@ -0,0 +1,16 @@
+"""Worker do RQ para as análises em segundo plano.
+
+Uso: python worker.py  (requer REDIS_URL)
+
+O módulo analise é importado aqui, antes de o worker começar: os processos
+criados para cada job herdam o import em vez de refazê-lo a cada análise.
+"""
+import os
+
+from redis import Redis
+from rq import Worker
+
+import analise  # noqa: F401
+
+if __name__ == '__main__':
+    Worker(['llm'], connection=Redis.from_url(os.environ['REDIS_URL'])).work()
@@ -0,0 +1,16 @@
+"""Ponto de entrada de produção.
+
+Uso: gunicorn wsgi:app  (as opções ficam em gunicorn.conf.py)
+"""
+import os
+
+if os.getenv('GUNICORN_WORKER_CLASS', 'gevent') == 'gevent':
+    # O monkey patch precisa acontecer antes de qualquer import que use sockets/ssl.
+    from gevent import monkey
+    monkey.patch_all()
+
+    # Torna o psycopg2 cooperativo com o gevent.
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+from api import app  # noqa: E402